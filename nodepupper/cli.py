@@ -74,6 +74,9 @@ def main():
     spr_addc.add_argument("cls", help="name of class to add")
     spr_addc.add_argument("-r", "--rename", help="rename class")
 
+    spr_editc = spr_action.add_parser("editclass", help="edit a class's parameter schema and defaults")
+    spr_editc.add_argument("cls", help="name of class to edit")
+
     spr_delc = spr_action.add_parser("delclass", help="delete a class")
     spr_delc.add_argument("cls", help="name of class to delete")
 
@@ -134,14 +137,38 @@ def main():
         r.put(args.host.rstrip("/") + "/api/class/" + args.cls,
               params={"rename": args.rename} if args.rename else None).raise_for_status()
 
+    elif args.action == "editclass":
+        req = r.get(args.host.rstrip("/") + "/api/class/" + args.cls)
+        req.raise_for_status()
+        body = req.text
+        newbody = None
+        with tempfile.TemporaryDirectory() as d:
+            tmppath = os.path.join(d, args.cls)
+            with open(tmppath, "w") as f:
+                f.write(body)
+            newbody = editorloop(tmppath, lambda content: yaml.load(content))
+        if newbody != body:
+            try:
+                r.put(args.host.rstrip("/") + "/api/class/" + args.cls, data=newbody).raise_for_status()
+            except Exception:
+                print("Your edits:\n")
+                print(newbody, "\n\n")
+                raise
+        else:
+            print("No changes, exiting")
+
     elif args.action == "delclass":
         r.delete(args.host.rstrip("/") + "/api/class/" + args.cls).raise_for_status()
 
     elif args.action == "dump":
         nodes = yaml.load(r.get(args.host.rstrip("/") + "/api/node").text)["nodes"]
 
-        dump = {"classes": yaml.load(r.get(args.host.rstrip("/") + "/api/class").text)["classes"],
-                "nodes": {}}
+        classes = yaml.load(r.get(args.host.rstrip("/") + "/api/class").text)["classes"]
+
+        dump = {"classes": {}, "nodes": {}}
+
+        for clsname in classes:
+            dump["classes"][clsname] = yaml.load(r.get(args.host.rstrip("/") + "/api/class/" + clsname).text)
 
         for nodename in nodes:
             dump["nodes"][nodename] = yaml.load(getnode(nodename))
@@ -152,8 +179,11 @@ def main():
         with open(args.fname) as f:
             dump = yaml.load(f)
 
-        for clsname in dump["classes"]:
-            r.put(args.host.rstrip("/") + "/api/class/" + clsname).raise_for_status()
+        # older dumps list class names only
+        classes = dump["classes"] if isinstance(dump["classes"], dict) else {c: None for c in dump["classes"]}
+        for clsname, clsbody in classes.items():
+            r.put(args.host.rstrip("/") + "/api/class/" + clsname,
+                  data=yaml.dump(clsbody) if clsbody else None).raise_for_status()
 
         # just make the nodes first
         for nodename, nodebody in dump["nodes"].items():
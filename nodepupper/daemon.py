@@ -1,7 +1,7 @@
 import os
 import cherrypy
 import logging
-from nodepupper.nodeops import NodeOps, NObject, NClass, NClassAttachment
+from nodepupper.nodeops import NodeOps, NObject, NClass, NClassAttachment, ValidationError
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from urllib.parse import urlparse
 import math
@@ -45,7 +45,7 @@ def recurse_params(node):
 
 
 def recurse_classes(node):
-    classes = {c.cls: c.conf for _, c in node.classes.items()}
+    classes = {c.cls: c.effective_params() for _, c in node.classes.items()}
     for item in node.parents:
         for cls, conf in recurse_classes(item).items():
             if cls not in classes:
@@ -125,7 +125,7 @@ class AppWeb(object):
         with self.nodes.db.transaction() as c:
             node = c.root.nodes[fqdn]
             doc = {"environment": "production",
-                   "classes": {cls.name: yaml.load(conf) or {} for cls, conf in recurse_classes(node).items()},
+                   "classes": {cls.name: params for cls, params in recurse_classes(node).items()},
                    "parameters": recurse_params(node)}
             cherrypy.response.headers["Content-type"] = "text/plain"
             return "---\n" + yamldump(doc)
@@ -190,7 +190,10 @@ class NodesApi(object):
             # restore class links
             newnode.classes.clear()
             for clsname, clsbody in nodeyaml["classes"].items():
-                newnode.classes[clsname] = NClassAttachment(c.root.classes[clsname], yamldump(clsbody))
+                try:
+                    newnode.classes[clsname] = NClassAttachment(c.root.classes[clsname], yamldump(clsbody))
+                except ValidationError as e:
+                    raise cherrypy.HTTPError(400, "{}: {}".format(clsname, e))
             # restore parent links
             newnode.parents.clear()
             for parent in nodeyaml["parents"]:
@@ -215,11 +218,27 @@ class ClassesApi(object):
 
     def GET(self, cls=None):
         with self.nodes.db.transaction() as c:
-            clslist = list(c.root.classes.keys())
+            if cls:
+                clsobj = c.root.classes.get(cls)
+                if clsobj is None:
+                    raise cherrypy.HTTPError(404)
+                output = {"schema": clsobj.schema or {},
+                          "defaults": clsobj.defaults or {}}
+            else:
+                clslist = list(c.root.classes.keys())
+        if cls:
+            return yamldump(output)
         clslist.sort()
-        yield yamldump({"classes": clslist})
+        return yamldump({"classes": clslist})
 
     def PUT(self, cls, rename=None):
+        body = cherrypy.request.body.read().decode('utf-8')
+        try:
+            clsyaml = yaml.load(body) if body.strip() else None
+        except yaml.YAMLError as e:
+            raise cherrypy.HTTPError(400, "invalid yaml: {}".format(e))
+        if clsyaml is not None and not isinstance(clsyaml, dict):
+            raise cherrypy.HTTPError(400, "class body must be a mapping")
         with self.nodes.db.transaction() as c:
             print(cls, rename)
             if rename:
@@ -227,8 +246,15 @@ class ClassesApi(object):
                 self.nodes.rename_cls(c, clsobj, cls)
             elif cls not in c.root.classes:
                 c.root.classes[cls] = NClass(cls)
-            else:
+            elif clsyaml is None:
                 raise cherrypy.HTTPError(500, "Nothing to do")
+            # set schema & defaults, revalidating every attachment of the class
+            if clsyaml is not None:
+                try:
+                    self.nodes.update_cls(c, c.root.classes[cls],
+                                          clsyaml.get("schema") or {}, clsyaml.get("defaults") or {})
+                except ValidationError as e:
+                    raise cherrypy.HTTPError(400, str(e))
 
     def DELETE(self, cls):
         with self.nodes.db.transaction() as c:
@@ -254,8 +280,10 @@ class NodesWeb(object):
     def op(self, node, op, clsname=None, config=None, parent=None):
         with self.nodes.db.transaction() as c:
             if op == "Attach" and clsname and config:
-                # TODO validate yaml
-                c.root.nodes[node].classes[clsname] = NClassAttachment(c.root.classes[clsname], config)
+                try:
+                    c.root.nodes[node].classes[clsname] = NClassAttachment(c.root.classes[clsname], config)
+                except ValidationError as e:
+                    raise cherrypy.HTTPError(400, str(e))
             elif op == "Add Parent" and parent:
                 c.root.nodes[node].parents.append(c.root.nodes[parent])
             elif op == "detach" and clsname:
@@ -291,32 +319,10 @@ class ClassWeb(object):
         raise cherrypy.HTTPRedirect("/classes/{}".format(name), 302)
 
 
-def main():
-    import argparse
-    import signal
-
-    parser = argparse.ArgumentParser(description="Photod photo server")
-
-    parser.add_argument('-p', '--port', default=8080, type=int, help="tcp port to listen on")
-    # parser.add_argument('-l', '--library', default="./library", help="library path")
-    # parser.add_argument('-c', '--cache', default="./cache", help="cache path")
-    parser.add_argument('-s', '--database', default=os.environ.get('DATABASE_URI', None),
-                        help="mysql:// connection uri")
-    parser.add_argument('--debug', action="store_true", help="enable development options")
-
-    args = parser.parse_args()
-
-    logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
-                        format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
-
-    if not args.database:
-        print("--database or $DATABASE_URI is required")
-        sys.exit(2)
-
-    library = NodeOps(args.database)
-
-    tpl_dir = os.path.join(APPROOT, "templates") if not args.debug else "templates"
-
+def setup_server(library, tpl_dir, port, host='0.0.0.0', debug=False, thread_pool=25, socket_queue_size=5):
+    """
+    Mount the web ui and api apps and apply the global server config. Does not start the engine.
+    """
     web = AppWeb(library, tpl_dir)
     napi = NodesApi(library)
     capi = ClassesApi(library)
@@ -331,7 +337,7 @@ def main():
                                          'error_page.404': web.error},
                                    '/static': {"tools.staticdir.on": True,
                                                "tools.staticdir.dir": os.path.join(APPROOT, "styles/dist")
-                                               if not args.debug else os.path.abspath("styles/dist")},
+                                               if not debug else os.path.abspath("styles/dist")},
                                    '/login': {'tools.auth_basic.on': True,
                                               'tools.auth_basic.realm': 'webapp',
                                               'tools.auth_basic.checkpassword': validate_password}})
@@ -343,14 +349,50 @@ def main():
         'tools.sessions.locking': 'explicit',
         'tools.sessions.timeout': 525600,
         'request.show_tracebacks': True,
-        'server.socket_port': args.port,
-        'server.thread_pool': 25,
-        'server.socket_host': '0.0.0.0',
+        'server.socket_port': port,
+        'server.thread_pool': thread_pool,
+        'server.socket_queue_size': socket_queue_size,
+        'server.socket_host': host,
         'server.show_tracebacks': True,
         'log.screen': False,
-        'engine.autoreload.on': args.debug
+        'engine.autoreload.on': debug
     })
 
+
+def main():
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description="Photod photo server")
+
+    parser.add_argument('-p', '--port', default=8080, type=int, help="tcp port to listen on")
+    # parser.add_argument('-l', '--library', default="./library", help="library path")
+    # parser.add_argument('-c', '--cache', default="./cache", help="cache path")
+    parser.add_argument('-s', '--database', default=os.environ.get('DATABASE_URI', None),
+                        help="mysql:// connection uri, or file:// for a local FileStorage")
+    parser.add_argument('--threads', default=25, type=int, help="http worker thread pool size")
+    parser.add_argument('--socket-queue', default=5, type=int, help="listen socket backlog size")
+    parser.add_argument('--db-pool', default=7, type=int,
+                        help="zodb connection pool size. A soft limit: connections past it are still opened, only "
+                             "their caches are not kept, so this does not cap db concurrency")
+    parser.add_argument('--debug', action="store_true", help="enable development options")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING,
+                        format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
+
+    if not args.database:
+        print("--database or $DATABASE_URI is required")
+        sys.exit(2)
+
+    library = NodeOps(args.database, pool_size=args.db_pool)
+
+    tpl_dir = os.path.join(APPROOT, "templates") if not args.debug else "templates"
+
+    setup_server(library, tpl_dir, args.port, debug=args.debug,
+                 thread_pool=args.threads, socket_queue_size=args.socket_queue)
+
     def signal_handler(signum, stack):
         logging.critical('Got sig {}, exiting...'.format(signum))
         cherrypy.engine.exit()
@@ -0,0 +1,352 @@
+import os
+import sys
+import math
+import time
+import yaml
+import random
+import logging
+import resource
+import requests
+import cherrypy
+import tempfile
+import itertools
+import threading
+import multiprocessing
+from nodepupper.nodeops import NodeOps
+from nodepupper.daemon import APPROOT, setup_server
+
+
+OPS = ("read", "put", "delete")
+
+
+def rss_mb():
+    """
+    Return the current resident set size of this process in MB. Where /proc isn't available fall back to the peak RSS,
+    which is in kilobytes on linux and bytes on macos
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+class Histogram(object):
+    """
+    Latency histogram with log spaced buckets 2% wide from 10us to 100s, so memory use stays constant no matter how
+    long a soak runs
+    """
+    MIN = 0.00001
+    GROWTH = 1.02
+    SIZE = int(math.log(10000000) / math.log(GROWTH)) + 2
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+
+    def add(self, value):
+        if value <= self.MIN:
+            idx = 0
+        else:
+            idx = min(self.SIZE - 1, int(math.log(value / self.MIN) / math.log(self.GROWTH)) + 1)
+        self.counts[idx] += 1
+        self.count += 1
+
+    def merge(self, other):
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.count += other.count
+
+    def percentile(self, pct):
+        """
+        Return the upper bound of the bucket holding the pct'th percentile sample
+        """
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.MIN * self.GROWTH ** idx
+
+
+def seed_layout(nodecount, classcount):
+    """
+    Build a deterministic tree of nodes; each node's parent is node (i - 1) // 4 and each node has 1-2 classes attached
+    """
+    layout = {}
+    for i in range(nodecount):
+        layout["node-{}".format(i)] = {
+            "fqdn": "node-{}".format(i),
+            "body": {"index": i, "role": "role{}".format(i % 7)},
+            "parents": ["node-{}".format((i - 1) // 4)] if i else [],
+            "classes": {"cls-{}".format((i + j) % classcount): {"slot": j} for j in range(1 + i % 2)}
+        }
+    return layout
+
+
+class Stats(object):
+    """
+    Per client request counters. Each client owns one so no locking is needed while the test runs; they are merged
+    per worker process and then across processes at the end
+    """
+    def __init__(self):
+        self.latencies = {op: Histogram() for op in OPS}
+        self.errors = {op: 0 for op in OPS}
+        self.conflicts = {op: 0 for op in OPS}
+        self.failures = {op: 0 for op in OPS}  # connection errors and timeouts; no http response at all
+
+    def record(self, op, elapsed, resp):
+        self.latencies[op].add(elapsed)
+        if resp.status_code >= 400:
+            self.errors[op] += 1
+            if "ConflictError" in resp.text:  # tracebacks are enabled, so conflicts are visible in the body
+                self.conflicts[op] += 1
+
+    def total(self):
+        return sum(h.count for h in self.latencies.values()) + sum(self.failures.values())
+
+    def merge(self, other):
+        for op in OPS:
+            self.latencies[op].merge(other.latencies[op])
+            self.errors[op] += other.errors[op]
+            self.conflicts[op] += other.conflicts[op]
+            self.failures[op] += other.failures[op]
+
+
+class LoadClient(threading.Thread):
+    """
+    Issues a weighted random mix of /puppet renders, node PUTs and node DELETEs until stopped. PUTs either rewrite a
+    seeded node or create a scratch node owned by this client; DELETEs only ever remove this client's scratch nodes so
+    the seeded tree stays renderable.
+    """
+    def __init__(self, num, base, layout, weights, stop, timeout):
+        super().__init__(daemon=True)
+        self.num = num
+        self.base = base
+        self.timeout = timeout
+        self.layout = layout
+        self.names = list(layout.keys())
+        self.weights = weights
+        self.stop = stop
+        self.stats = Stats()
+        self.rng = random.Random(num)
+        self.scratch = []
+        self.created = 0
+        self.s = requests.session()
+
+    def new_scratch(self):
+        name = "scratch-{}-{}".format(self.num, self.created)
+        self.created += 1
+        body = {"fqdn": name, "body": {"owner": self.num}, "classes": {},
+                "parents": [self.rng.choice(self.names)]}
+        return name, self.s.put("{}/api/node/{}".format(self.base, name), data=yaml.dump(body),
+                                timeout=self.timeout)
+
+    def run(self):
+        while not self.stop.is_set():
+            op = self.rng.choices(OPS, self.weights)[0]
+            try:
+                self.request(op)
+            except requests.RequestException:
+                self.stats.failures[op] += 1
+
+    def request(self, op):
+        if op == "delete" and not self.scratch:
+            name, resp = self.new_scratch()  # untimed setup for the delete
+            if resp.status_code < 400:
+                self.scratch.append(name)
+            return
+        start = time.perf_counter()
+        if op == "read":
+            resp = self.s.get("{}/puppet".format(self.base), params={"fqdn": self.rng.choice(self.names)},
+                              timeout=self.timeout)
+        elif op == "put" and self.rng.random() < 0.5:
+            node = dict(self.layout[self.rng.choice(self.names)])
+            node["body"] = dict(node["body"], serial=self.rng.random())
+            resp = self.s.put("{}/api/node/{}".format(self.base, node["fqdn"]), data=yaml.dump(node),
+                              timeout=self.timeout)
+        elif op == "put":
+            name, resp = self.new_scratch()
+            if resp.status_code < 400:
+                self.scratch.append(name)
+        else:
+            resp = self.s.delete("{}/api/node/{}".format(self.base, self.scratch.pop()), timeout=self.timeout)
+        self.stats.record(op, time.perf_counter() - start, resp)
+
+
+def seed(base, layout, classcount, timeout):
+    s = requests.session()
+    for i in range(classcount):
+        s.put("{}/api/class/cls-{}".format(base, i), timeout=timeout).raise_for_status()
+    for name, node in layout.items():  # seed_layout inserts parents before their children, so links resolve
+        s.put("{}/api/node/{}".format(base, name), data=yaml.dump(node), timeout=timeout).raise_for_status()
+
+
+def client_worker(nums, base, layout, weights, timeout, go, stop, progress, results):
+    """
+    Body of a client worker process. Runs one LoadClient thread per client number in nums, keeping them off the
+    server's interpreter and GIL, and publishes a request count to progress while they run
+    """
+    stop_threads = threading.Event()
+    clients = [LoadClient(num, base, layout, weights, stop_threads, timeout) for num in nums]
+    results.put("ready")
+    go.wait()
+    for client in clients:
+        client.start()
+    while not stop.wait(0.25):
+        progress.value = sum(c.stats.total() for c in clients)
+    stop_threads.set()
+    stats = Stats()
+    for client in clients:
+        client.join()
+        stats.merge(client.stats)
+    results.put(stats)
+
+
+def quiet_logs():
+    """
+    Keep per-request access logs and zodb's pool size warnings from burying the report and loading the server
+    """
+    cherrypy.log.access_log.propagate = False
+    logging.getLogger("ZODB.DB").addFilter(lambda record: "pool_size" not in record.getMessage())
+
+
+def run_once(args, layout, weights, threads, socket_queue, db_pool):
+    """
+    Start the daemon in-process on a fresh FileStorage, seed it, drive it for args.duration seconds and return a
+    summary dict
+    """
+    print("== threads={} socket_queue={} db_pool={} clients={}".format(threads, socket_queue, db_pool, args.clients))
+    with tempfile.TemporaryDirectory() as d:
+        library = NodeOps("file://" + os.path.join(d, "pupper.db"), pool_size=db_pool)
+        setup_server(library, os.path.join(APPROOT, "templates"), args.port, host="127.0.0.1",
+                     thread_pool=threads, socket_queue_size=socket_queue)
+        quiet_logs()
+        cherrypy.server.httpserver = None  # rebuilt from the new config on start
+        cherrypy.engine.start()
+        try:
+            base = "http://127.0.0.1:{}".format(args.port)
+            seed(base, layout, args.classes, args.timeout)
+
+            ctx = multiprocessing.get_context("spawn")  # don't fork a process that has server threads running
+            go, stop, results = ctx.Event(), ctx.Event(), ctx.Queue()
+            workers = []
+            for i in range(min(args.procs, args.clients)):
+                progress = ctx.Value("L", 0)
+                proc = ctx.Process(target=client_worker, daemon=True,
+                                   args=(list(range(i, args.clients, args.procs)), base, layout, weights,
+                                         args.timeout, go, stop, progress, results))
+                proc.start()
+                workers.append((proc, progress))
+            for _ in workers:
+                results.get()  # wait for every worker to be ready so interpreter startup isn't measured
+
+            rss_start = rss_mb()
+            started = time.time()
+            go.set()
+
+            last_total, last_sample = 0, started
+            while time.time() - started < args.duration:
+                time.sleep(min(args.interval, max(0, args.duration - (time.time() - started))))
+                now = time.time()
+                total = sum(progress.value for _, progress in workers)
+                rss = rss_mb()
+                print("  t={:>5.0f}s  req/s={:>8.1f}  server_rss={:>7.1f}MB ({:+.1f})  zodb_cache={}"
+                      .format(now - started, (total - last_total) / max(now - last_sample, 0.001), rss,
+                              rss - rss_start, library.db.cacheSize()))
+                last_total, last_sample = total, now
+
+            stop.set()
+            stats = Stats()
+            for _ in workers:
+                stats.merge(results.get())  # drain before joining so a full pipe can't block the worker's exit
+            for proc, _ in workers:
+                proc.join()
+            elapsed = time.time() - started
+            rss_growth = rss_mb() - rss_start
+        finally:
+            cherrypy.engine.stop()
+            library.db.close()
+
+    latencies = dict(stats.latencies, all=Histogram())
+    errors = dict(stats.errors)
+    conflicts = dict(stats.conflicts)
+    failures = dict(stats.failures)
+    for op in OPS:
+        latencies["all"].merge(stats.latencies[op])
+    for counter in (errors, conflicts, failures):
+        counter["all"] = sum(counter.values())
+
+    print("  {:<8} {:>8} {:>9} {:>9} {:>9} {:>7} {:>9} {:>8}".format("op", "count", "req/s", "p50 ms", "p99 ms",
+                                                                     "errors", "conflicts", "failures"))
+    for op in OPS + ("all", ):
+        hist = latencies[op]
+        print("  {:<8} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>7} {:>9} {:>8}".format(
+            op, hist.count, hist.count / elapsed, hist.percentile(50) * 1000, hist.percentile(99) * 1000,
+            errors[op], conflicts[op], failures[op]))
+
+    total = latencies["all"]
+    return {"threads": threads,
+            "socket_queue": socket_queue,
+            "db_pool": db_pool,
+            "rps": total.count / elapsed,
+            "p50": total.percentile(50) * 1000,
+            "p99": total.percentile(99) * 1000,
+            "conflict_rate": conflicts["all"] / max(1, total.count),
+            "failures": failures["all"],
+            "rss_growth": rss_growth}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load and soak test nodepupperd in-process against a local "
+                                                 "FileStorage. Multiple values for --threads, --socket-queue and "
+                                                 "--db-pool are swept as a grid.")
+
+    parser.add_argument('-p', '--port', default=8099, type=int, help="tcp port for the in-process server")
+    parser.add_argument('-d', '--duration', default=30, type=float, help="seconds to run each configuration")
+    parser.add_argument('-c', '--clients', default=50, type=int, help="number of concurrent clients")
+    parser.add_argument('-w', '--procs', default=os.cpu_count() or 4, type=int,
+                        help="worker processes to spread the clients across")
+    parser.add_argument('-i', '--interval', default=5, type=float, help="seconds between progress samples")
+    parser.add_argument('-t', '--timeout', default=30, type=float, help="per request timeout in seconds")
+    parser.add_argument('--nodes', default=200, type=int, help="number of nodes to seed")
+    parser.add_argument('--classes', default=20, type=int, help="number of classes to seed")
+    parser.add_argument('--mix', default="80,15,5", help="read,put,delete request weights")
+    parser.add_argument('--threads', nargs="+", default=[25], type=int, help="http worker thread pool size(s)")
+    parser.add_argument('--socket-queue', nargs="+", default=[5], type=int, help="listen socket backlog size(s)")
+    parser.add_argument('--db-pool', nargs="+", default=[7], type=int,
+                        help="zodb connection pool size(s). A soft limit: connections past it are still opened, "
+                             "only their caches are not kept, so this does not cap db concurrency")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)-15s %(levelname)-8s %(filename)s:%(lineno)d %(message)s")
+
+    weights = [float(i) for i in args.mix.split(",")]
+    if len(weights) != len(OPS):
+        parser.error("--mix needs {} comma separated weights".format(len(OPS)))
+
+    layout = seed_layout(args.nodes, args.classes)
+
+    results = []
+    try:
+        for threads, socket_queue, db_pool in itertools.product(args.threads, args.socket_queue, args.db_pool):
+            results.append(run_once(args, layout, weights, threads, socket_queue, db_pool))
+    finally:
+        cherrypy.engine.exit()
+
+    print("\n{:>7} {:>12} {:>7} {:>9} {:>9} {:>9} {:>10} {:>8} {:>12}".format(
+        "threads", "socket_queue", "db_pool", "req/s", "p50 ms", "p99 ms", "conflicts", "failures", "rss growth"))
+    for r in results:
+        print("{threads:>7} {socket_queue:>12} {db_pool:>7} {rps:>9.1f} {p50:>9.2f} {p99:>9.2f} "
+              "{conflict_rate:>10.2%} {failures:>8} {rss_growth:>+10.1f}MB".format(**r))
+
+
+if __name__ == '__main__':
+    main()
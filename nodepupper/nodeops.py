@@ -1,5 +1,9 @@
 from urllib.parse import urlparse
+import copy
+import logging
+import yaml
 import ZODB
+import ZODB.FileStorage
 from relstorage.storage import RelStorage
 from relstorage.options import Options
 from relstorage.adapters.mysql import MySQLAdapter
@@ -17,6 +21,62 @@ def pmap():
     return persistent.mapping.PersistentMapping()
 
 
+class ValidationError(Exception):
+    pass
+
+
+PARAM_TYPES = {
+    "str": lambda v: isinstance(v, str),
+    "int": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "float": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "bool": lambda v: isinstance(v, bool),
+    "list": lambda v: isinstance(v, list),
+    "dict": lambda v: isinstance(v, dict),
+    "any": lambda v: True,
+}
+
+
+def compile_schema(schema, defaults):
+    """
+    Build a function that validates an attachment's params against a class schema ({param: typename}) and returns
+    them merged over the class defaults. An empty schema accepts any params. Raises ValidationError if the schema or
+    the defaults themselves are invalid.
+    """
+    if not isinstance(schema, dict):
+        raise ValidationError("schema must be a mapping")
+    if not isinstance(defaults, dict):
+        raise ValidationError("defaults must be a mapping")
+    checks = {}
+    for param, typename in schema.items():
+        if not isinstance(typename, str) or typename not in PARAM_TYPES:
+            raise ValidationError("unknown type '{}' for param '{}'".format(typename, param))
+        checks[param] = (typename, PARAM_TYPES[typename])
+    required = set(checks) - set(defaults)
+
+    def typecheck(params):
+        errors = []
+        for param, value in params.items():
+            if param not in checks:
+                if checks:
+                    errors.append("unknown param '{}'".format(param))
+            elif not checks[param][1](value):
+                errors.append("param '{}' must be {}".format(param, checks[param][0]))
+        return errors
+
+    errors = typecheck(defaults)
+    if errors:
+        raise ValidationError("invalid defaults: " + ", ".join(errors))
+
+    def validate(params):
+        errors = typecheck(params) + ["missing param '{}'".format(p) for p in sorted(required - set(params))]
+        if errors:
+            raise ValidationError(", ".join(errors))
+        merged = copy.deepcopy(defaults)
+        merged.update(params)
+        return merged
+    return validate
+
+
 class NObject(persistent.Persistent):
     def __init__(self, fqdn, body):
         self.fqdn = fqdn
@@ -32,25 +92,100 @@ class NObject(persistent.Persistent):
 
 
 class NClass(persistent.Persistent):
+    # fallbacks for classes stored before they carried params
+    schema = None
+    defaults = None
+    version = 0
+
     def __init__(self, name):
         self.name = name
+        self.set_params({}, {})
+
+    def set_params(self, schema, defaults):
+        """
+        Replace the class's schema and defaults. Raises ValidationError, leaving the class untouched, if they are
+        invalid. Existing attachments must be refreshed afterwards; see NodeOps.update_cls.
+        """
+        compile_schema(schema, defaults)
+        self.schema = schema
+        self.defaults = defaults
+        self.version += 1
+
+    def validator(self):
+        """
+        Return the compiled schema, compiling it only once per class version
+        """
+        compiled = getattr(self, "_v_validator", None)
+        if compiled is None or compiled[0] != self.version:
+            compiled = self._v_validator = (self.version, compile_schema(self.schema or {}, self.defaults or {}))
+        return compiled[1]
+
+    def validate(self, conf):
+        """
+        Parse an attachment's yaml conf and return its effective params. Raises ValidationError if invalid.
+        """
+        try:
+            params = yaml.load(conf) if conf else None
+        except yaml.YAMLError as e:
+            raise ValidationError("invalid yaml: {}".format(e))
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            raise ValidationError("config must be a mapping")
+        return self.validator()(params)
 
 
 class NClassAttachment(persistent.Persistent):
+    # fallbacks for attachments stored before params were precomputed
+    params = None
+    cls_version = None
+
     def __init__(self, cls, conf):
         self.cls = cls
         self.conf = conf
+        self.refresh()
+
+    def refresh(self):
+        """
+        Validate conf against the class and store the params merged over the class defaults
+        """
+        if self.cls._p_jar is not None:
+            # conflict if the class's schema or defaults are changed by a concurrent transaction
+            self.cls._p_jar.readCurrent(self.cls)
+        self.params = self.cls.validate(self.conf)
+        self.cls_version = self.cls.version
+
+    def effective_params(self):
+        """
+        Return the precomputed params, or recompute them if the class changed since they were stored. That only
+        happens for attachments stored before params were precomputed, or ones on a node created while update_cls was
+        running. If they no longer validate, fall back to the last stored params or, failing that, the conf as it
+        rendered before validation existed, so one stale attachment can't break rendering.
+        """
+        if self.params is not None and self.cls_version == self.cls.version:
+            return self.params
+        try:
+            return self.cls.validate(self.conf)
+        except ValidationError as e:
+            logging.warning("stale attachment of class '%s' is invalid, rendering last known params: %s",
+                            self.cls.name, e)
+            if self.params is not None:
+                return self.params
+            return yaml.load(self.conf) or {}
 
 
 class NodeOps(object):
-    def __init__(self, db_uri):
+    def __init__(self, db_uri, pool_size=7):
         uri = urlparse(db_uri)
 
-        self.mysql = MySQLAdapter(host=uri.hostname, port=uri.port,
-                                  user=uri.username, passwd=uri.password,
-                                  db=uri.path[1:], options=Options(keep_history=False))
-        self.storage = RelStorage(adapter=self.mysql)
-        self.db = ZODB.DB(self.storage)
+        if uri.scheme == "file":  # local FileStorage, e.g. file:///tmp/pupper.db
+            self.storage = ZODB.FileStorage.FileStorage(uri.path)
+        else:
+            self.mysql = MySQLAdapter(host=uri.hostname, port=uri.port,
+                                      user=uri.username, passwd=uri.password,
+                                      db=uri.path[1:], options=Options(keep_history=False))
+            self.storage = RelStorage(adapter=self.mysql)
+        self.db = ZODB.DB(self.storage, pool_size=pool_size)
 
         with self.db.transaction() as c:
             if "nodes" not in c.root():
@@ -77,3 +212,18 @@ class NodeOps(object):
         del c.root.classes[cls.name]
         cls.name = newname
         c.root.classes[cls.name] = cls
+
+    def update_cls(self, c, cls, schema, defaults):
+        """
+        Set a class's schema and defaults and recompute the params of every attachment of it. Raises ValidationError if
+        any existing attachment doesn't satisfy the new schema; the caller's transaction should then be aborted.
+        """
+        cls.set_params(schema, defaults)
+        for node in c.root.nodes.values():
+            c.readCurrent(node.classes)  # conflict with concurrent attaches that validated against the old schema
+            for attachment in node.classes.values():
+                if attachment.cls is cls:
+                    try:
+                        attachment.refresh()
+                    except ValidationError as e:
+                        raise ValidationError("{}: {}".format(node.fqdn, e))
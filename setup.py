@@ -20,7 +20,8 @@ setup(name='nodepupper',
       entry_points={
           "console_scripts": [
               "nodepupperd = nodepupper.daemon:main",
-              "npcli = nodepupper.cli:main"
+              "npcli = nodepupper.cli:main",
+              "nploadtest = nodepupper.loadtest:main"
           ]
       },
       include_package_data=True,